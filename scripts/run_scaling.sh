@@ -5,10 +5,10 @@
 set -euo pipefail
 
 # Parameters
-ITERATIONS=1000
+ITERATIONS=(1000)  # run time parameter: one compile per size for all counts
 KERNELS=(2 4 8 16 32 64 128 256 512 700)
 INPUTS=(128 256 512 1024 2048 4096 8192 16384 32768 44800)
-CHANNELS=1
+CHANNELS=0  # fastest measured by src/wse/memcpy-bench
 
 LOGFILE="../../../logs/scaling.log"
 
@@ -34,10 +34,11 @@ run_weak_scaling() {
             --kernel-dim-y "$KERNEL_Y" \
             --inp-rows "$ROWS" \
             --inp-cols "$COLS" \
-            --iterations "$ITERATIONS" \
             --channels "$CHANNELS"
 
-        python "appliance_run.py" | tee -a "$LOGFILE"
+        for ITERS in "${ITERATIONS[@]}"; do
+            python "appliance_run.py" --iterations "$ITERS" | tee -a "$LOGFILE"
+        done
     done
 
     echo "--------------------------------------------------" | tee -a "$LOGFILE"
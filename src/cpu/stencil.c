@@ -1,46 +1,113 @@
-#include <stdio.h>
 #include <stdlib.h>
 
-int main()
+/*
+  CPU reference of the WSE stencil kernels, built as a shared library
+  and called from utils.py through ctypes.
+
+  Terms are accumulated in the same order as the wse kernel:
+  - center, north, south, west, east (+ NW, NE, SW, SE for box)
+  - starting from the outer halo
+  Build with -ffp-contract=off: every product is rounded to float before
+  it is added, as on the device.
+*/
+
+#define STAR2D 0
+#define BOX2D  1
+
+typedef struct {
+  float c;
+  int di;
+  int dj;
+} term_t;
+
+static int star_terms(const float* c, int radius, term_t* t)
 {
-  int M = 8;  // rows
-  int N = 8;  // cols
-  int iterations = 10;
-
-  float* A = (float*) malloc(M*N *sizeof(float));
-  float* A_aux = (float*) calloc(M*N, sizeof(float));
-  
-  float x = 0;
-  for(int i = 0; i < M; i++){
-    for(int j = 0; j < N; j++){
-      A[i*N + j] = x;
-      x++;
-    }
-  }
+  int k = 0;
+  int len = 4*radius + 1;
+
+  t[k++] = (term_t){c[2*radius], 0, 0};                                               // center
+  for(int r = 0; r < radius; r++) t[k++] = (term_t){c[r], -(radius-r), 0};            // north
+  for(int r = 0; r < radius; r++) t[k++] = (term_t){c[len-r-1], radius-r, 0};         // south
+  for(int r = 0; r < radius; r++) t[k++] = (term_t){c[radius+r], 0, -(radius-r)};     // west
+  for(int r = 0; r < radius; r++) t[k++] = (term_t){c[2*radius+r+1], 0, radius-r};    // east
+
+  return k;
+}
+
+static int box_terms(const float* c, int radius, term_t* t)
+{
+  int k = 0;
+  int s = 2*radius + 1; // stencil side
+
+  t[k++] = (term_t){c[radius*(s+1)], 0, 0};                                                 // C
+  for(int r = 0; r < radius; r++) t[k++] = (term_t){c[radius + r*s], -(radius-r), 0};       // N
+  for(int r = 0; r < radius; r++) t[k++] = (term_t){c[radius + (s-1-r)*s], radius-r, 0};    // S
+  for(int r = 0; r < radius; r++) t[k++] = (term_t){c[radius*s + r], 0, -(radius-r)};       // W
+  for(int r = 0; r < radius; r++) t[k++] = (term_t){c[(radius+1)*s - (r+1)], 0, radius-r};  // E
+
+  for(int ri = 0; ri < radius; ri++)  // NW
+    for(int rj = 0; rj < radius; rj++) t[k++] = (term_t){c[ri*s + rj], -(radius-ri), -(radius-rj)};
+  for(int ri = 0; ri < radius; ri++)  // NE
+    for(int rj = 0; rj < radius; rj++) t[k++] = (term_t){c[ri*s + (s-rj-1)], -(radius-ri), radius-rj};
+  for(int ri = 0; ri < radius; ri++)  // SW
+    for(int rj = 0; rj < radius; rj++) t[k++] = (term_t){c[(s-1-ri)*s + rj], radius-ri, -(radius-rj)};
+  for(int ri = 0; ri < radius; ri++)  // SE
+    for(int rj = 0; rj < radius; rj++) t[k++] = (term_t){c[(radius+1+ri)*s + (radius+1+rj)], 1+ri, 1+rj};
+
+  return k;
+}
 
-  for(int iter = 0; iter < iterations; iter++){
-    for(int i = 0; i < M; i++){
-      for(int j = 0; j < N; j++){
-        if(i-1 >= 0)  A_aux[i*N + j] += A[(i-1)*N + j];
-        if(i+1 < M)   A_aux[i*N + j] += A[(i+1)*N + j];
-        if(j-1 >= 0)  A_aux[i*N + j] += A[i*N + j-1];
-        A_aux[i*N + j] -= 4.0 * A[i*N + j];
-        if(j+1 < N)   A_aux[i*N + j] += A[i*N + j+1];
+/*
+  Runs iters stencil steps on the m x n grid y, using y_aux as second buffer.
+  Returns 0 if the result is in y, 1 if it is in y_aux, -1 on bad arguments.
+*/
+int stencil(float* y, float* y_aux, int m, int n, const float* c, int shape, int radius, int iters)
+{
+  if(radius < 1) return -1;
+
+  int s = 2*radius + 1;
+  term_t* terms = (term_t*) malloc(s*s * sizeof(term_t));
+  int n_terms;
+
+  if(shape == STAR2D)     n_terms = star_terms(c, radius, terms);
+  else if(shape == BOX2D) n_terms = box_terms(c, radius, terms);
+  else { free(terms); return -1; }
+
+  for(int iter = 0; iter < iters; iter++){
+
+    #pragma omp parallel for schedule(static)
+    for(int i = 0; i < m; i++){
+      float* out = &y_aux[(long)i*n];
+      const float* in = &y[(long)i*n];
+
+      for(int j = 0; j < n; j++) out[j] = terms[0].c * in[j];
+
+      for(int k = 1; k < n_terms; k++){
+        int ii = i + terms[k].di;
+        int dj = terms[k].dj;
+        if(ii < 0 || ii >= m) continue;
+
+        const float* nb = &y[(long)ii*n + dj];
+        float coef = terms[k].c;
+        int j0 = dj < 0 ? -dj : 0;
+        int j1 = dj > 0 ? n - dj : n;
+
+        for(int j = j0; j < j1; j++){
+          float p = coef * nb[j];
+          out[j] = out[j] + p;
+        }
       }
+
+      // reset input point to original value
+      if(i < n) out[i] = in[i];
     }
 
-    float* temp = A;
-    A = A_aux;
-    A_aux = temp;
+    float* temp = y;
+    y = y_aux;
+    y_aux = temp;
   }
 
-  FILE* fp = fopen("./logs/c_result.txt","w+");
-  for(int i = 0; i < M; i++){
-    for(int j = 0; j < N; j++){
-      printf("%f ", A[i*N +j]);
-      fprintf(fp, "%.1f \n", A[i*N +j]);
-    }
-    printf("\n");
-  }
-  fclose(fp);
-}
\ No newline at end of file
+  free(terms);
+
+  return iters % 2;
+}
@@ -3,22 +3,35 @@
 : "${inp_rows:=16}"
 : "${inp_cols:=16}"
 : "${iterations:=1}"
+: "${decimate:=0}"
+: "${snapshot:=0}"
+: "${slots:=1}"
+: "${fields:=1}"
+: "${channels:=0}"
 : "${arch:=wse3}"
 
 fabric_dim_x=$((7 + kernel_dim_x))
 fabric_dim_y=$((2 + kernel_dim_y))
 
 run_worker() {
+    # channel count measured to be the fastest for this transfer, unless given
+    if (( channels == 0 )); then
+        elements=$(( ((inp_rows + kernel_dim_y - 1)/kernel_dim_y + 2) * ((inp_cols + kernel_dim_x - 1)/kernel_dim_x + 2) ))
+        channels=$(python3 ../memcpy-bench/channels.py --kernel-dim-x $kernel_dim_x --kernel-dim-y $kernel_dim_y --elements $elements)
+    fi
+
+    # compiled only if the CSL sources or the options changed
+    python3 ../compile_cache.py compile --out out --sources . -- \
     cslc --arch=$arch layout.csl \
     --fabric-dims=$fabric_dim_x,$fabric_dim_y \
     --fabric-offsets=4,1 \
-    --params=kernel_dim_x:$kernel_dim_x,kernel_dim_y:$kernel_dim_y,M:$inp_rows,N:$inp_cols,iterations:$iterations \
-    -o out --memcpy --channels 1
+    --params=kernel_dim_x:$kernel_dim_x,kernel_dim_y:$kernel_dim_y,M:$inp_rows,N:$inp_cols,decimate:$decimate,snapshot:$snapshot,slots:$slots,fields:$fields \
+    -o out --memcpy --channels $channels
 
     echo ""
     echo "Running with kernel: ${kernel_dim_x}x${kernel_dim_y}, input: ${inp_rows}x${inp_cols}, iterations: $iterations"
 
-    cs_python run.py --name out --arch=$arch --verify
+    cs_python run.py --name out --arch=$arch --iterations $iterations --verify
 }
 
 # If script is sourced, don't auto-run
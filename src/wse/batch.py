@@ -0,0 +1,71 @@
+#!/usr/bin/env cs_python
+
+import argparse
+import glob
+import os
+import numpy as np
+
+from utils import *
+
+'''
+  Runs a batch of jobs on one compiled program, loaded once: each job is a
+  .npz file with the initial field "A" (up to the compiled M x N, B x M x N
+  on a program compiled with fields = B) and the coefficients "c". Results
+  are saved as <job>.npy in the output directory.
+  With --pipeline, jobs of the same shape are double buffered on a program
+  compiled with slots = 2: copies overlap with the compute of other jobs.
+'''
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', help="the test compile output dir")
+parser.add_argument('--cmaddr', help="IP:port for CS system")
+parser.add_argument("--shape", required=True, choices=["star2d", "box2d"], help="stencil shape of the program")
+parser.add_argument("--jobs", required=True, help="directory of the .npz jobs")
+parser.add_argument("--out", default="results", help="directory of the results")
+parser.add_argument("--iterations", type=int, default=None, help="Iterations of each job (default: the compiled value)")
+parser.add_argument("--interior-io", action="store_true", help="Copy only the PE interiors, halos are placed on device")
+parser.add_argument("--pipeline", action="store_true", help="Overlap the copies of a job with compute (program compiled with slots = 2)")
+parser.add_argument("--verify", action="store_true", help="Verify each result")
+args = parser.parse_args()
+
+os.makedirs(args.out, exist_ok=True)
+jobs = sorted(glob.glob(os.path.join(args.jobs, "*.npz")))
+
+def save(path, job, y):
+  name = os.path.splitext(os.path.basename(path))[0]
+  np.save(os.path.join(args.out, f"{name}.npy"), y)
+
+  if args.verify:
+    M, N = y.shape[-2:]
+    check_result(job["A"], y, M, N, job["c"], args.shape, session.radius, session.iterations)
+
+  return name
+
+with Session(args.name, args.shape, cmaddr=args.cmaddr, interior_io=args.interior_io) as session:
+  if args.pipeline:
+    # runs of consecutive jobs with the same shape
+    groups = []
+    for path in jobs:
+      job = np.load(path)
+      if groups and groups[-1][0] == job["A"].shape: groups[-1][1].append(path)
+      else: groups.append((job["A"].shape, [path]))
+
+    for _, paths in groups:
+      loaded = [np.load(path) for path in paths]
+      results = session.pipeline(((job["A"], job["c"]) for job in loaded), args.iterations)
+      for path, job, y in zip(paths, loaded, results):
+        save(path, job, y)
+      print(f'{len(paths)} jobs in {session.times["total"]} s, {session.times["total"] / len(paths)} s/job')
+  else:
+    outs = {}  # result buffers, one per job shape
+
+    for path in jobs:
+      job = np.load(path)
+      shape = job["A"].shape
+      if shape not in outs: outs[shape] = np.zeros(shape, dtype=np.float32)
+      y = outs[shape]
+      session.run(job["A"], job["c"], args.iterations, out=y)
+
+      name = save(path, job, y)
+      print(f'{name},{session.times["h2d"]},{session.times["compute"]},{session.times["d2h"]}')
+
+print(f'{len(jobs)} jobs in {args.out}')
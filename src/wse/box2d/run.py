@@ -17,28 +17,51 @@ with open(f"{args.name}/out.json", "r", encoding="utf8") as f:
 
 w = int(data['params']['kernel_dim_x'])
 h = int(data['params']['kernel_dim_y'])
-N = int(data['params']['N'])
-M = int(data['params']['M'])
-iterations = int(data['params']['iterations'])
+# the program holds up to M x N, a smaller input is set at run time
+cap_N = int(data['params']['N'])
+cap_M = int(data['params']['M'])
+N = args.inp_cols or cap_N
+M = args.inp_rows or cap_M
+iterations = args.iterations if args.iterations is not None else int(data['params'].get('iterations', 1))
+decimate = int(data['params'].get('decimate', 0))
+snapshot = int(data['params'].get('snapshot', 0))
 radius = int(data['params']['radius'])
+fields = int(data['params'].get('fields', 1))
+
+if(args.checkpoint_dir and snapshot <= 0):
+  raise Exception(f'Program "{args.name}" was not compiled with snapshot > 0, needed by checkpoints!')
+
+streamed = args.memcpy_mode == "stream"
+if(streamed and (args.interior_io or args.roi or args.restart or snapshot > 0)):
+  raise Exception('Streaming mode does not support --interior-io, --roi, --restart or snapshots!')
+
+if(fields > 1 and args.roi):
+  raise Exception(f'Program "{args.name}" holds {fields} fields per PE, --roi needs a single field!')
 
 
 # Input
 heat_value = 10
-A = generate_input(M, N, "diagonal", value=heat_value)
-A_prepared = prepare_input(A, M, N, h, w, radius)
+if fields > 1:
+  # one input per field, stacked as a B x M x N batch
+  A = generate_fields(fields, M, N, args.input, value=heat_value, path=args.input_file)
+elif verify:
+  A = generate_input(M, N, args.input, value=heat_value, path=args.input_file)
+else:
+  # tiles are generated on demand by the h2d path and the sampled verification
+  A = LazyInput(args.input, M, N, value=heat_value, path=args.input_file)
 
 coefficients = get_coefficients("box2d", radius)
 c_tiled = np.tile(coefficients, w*h)
 
-pad_x, pad_y = 0, 0
-if (M % h != 0): pad_x = h - (M%h)
-if (N % w != 0): pad_y = w - (N%w)
-pe_M = (M + pad_x) // h
-pe_N = (N + pad_y) // w
-tiled_shape = (pe_M + 2*radius, pe_N + 2*radius)
+pe_M, pe_N, _, _ = pe_geometry(M, N, w, h)
+sizes = pe_sizes(M, N, w, h, cap_M, cap_N, radius, decimate)
 elements_per_PE = (pe_M + 2*radius) * (pe_N + 2*radius)
 
+# interior-only transfers skip the halos, the device places the interior itself
+# (always the case in streaming mode)
+io_halo = 0 if args.interior_io or streamed else radius
+io_elements = fields * (pe_M + 2*io_halo) * (pe_N + 2*io_halo)
+
 runner = SdkRuntime(args.name, cmaddr=args.cmaddr)
 
 runner.load()
@@ -47,30 +70,137 @@ runner.run()
 A_symbol = runner.get_id('A')
 coeff_symbol = runner.get_id('c')
 symbol_maxmin_time = runner.get_id("maxmin_time")
+io_symbol = runner.get_id('A_io') if args.interior_io else A_symbol
+iter_symbol = runner.get_id('iter')
+iterations_symbol = runner.get_id('iterations')
+
+# memcpy stream colors (MEMCPYH2D_DATA_1 / MEMCPYD2H_DATA_1 of layout.csl)
+h2d_color = int(data['params'].get('MEMCPYH2D_DATA_1_ID', 8))
+d2h_color = int(data['params'].get('MEMCPYD2H_DATA_1_ID', 9))
+
+# Iteration count of this run
+if(iterations <= 0):
+  raise Exception(f'Iterations must be greater than 0, not {iterations}!')
+runner.memcpy_h2d(iterations_symbol, np.full(w*h, iterations, dtype=np.int32), 0, 0, w, h, 1, streaming=False,
+  order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
 
-# Load matrix
-A_prepared = prepare_input(A, M, N, h, w, radius)
-
-start_time = time.perf_counter()
+# Local matrix sizes of this run, if smaller than the compiled ones
+if((M, N) != (cap_M, cap_N)):
+  runner.memcpy_h2d(runner.get_id('sizes'), sizes, 0, 0, w, h, 4, streaming=False,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+  runner.launch('resize', nonblock=False)
 
-runner.memcpy_h2d(A_symbol, A_prepared, 0, 0, w, h, elements_per_PE, streaming=False,
-  order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+# Load matrix
+def send_band(band, y0, rows):
+  if streamed:
+    runner.memcpy_h2d(h2d_color, band, 0, y0, w, rows, io_elements, streaming=True,
+      order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+  else:
+    runner.memcpy_h2d(io_symbol, band, 0, y0, w, rows, io_elements, streaming=False,
+      order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+
+if streamed:
+  # coefficients first: compute is armed before the input streams in, and
+  # each PE starts as soon as its own tile has arrived
+  runner.memcpy_h2d(coeff_symbol, c_tiled, 0, 0, w, h, len(coefficients), streaming=False,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+  runner.launch('compute_streamed', nonblock=False)  # returns at once
+
+# checkpoints hold the tiled io buffer of this layout
+ckpt_meta = dict(name=args.name, M=M, N=N, w=w, h=h, halo=io_halo, iterations=iterations, fields=fields)
+start_iter = 0
+
+if args.restart:
+  A_prepared, start_iter = load_run_checkpoint(args.restart, ckpt_meta)
+  if(start_iter >= iterations):
+    raise Exception(f'Checkpoint "{args.restart}" is already at iteration {start_iter}!')
+  print(f"Restart from iteration {start_iter}")
+
+  start_time = time.perf_counter()
+  send_band(A_prepared, 0, h)
+  runner.memcpy_h2d(iter_symbol, np.full(w*h, start_iter, dtype=np.int32), 0, 0, w, h, 1, streaming=False,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+elif args.stream_band > 0:
+  # band preparation overlaps with the copy of the previous band
+  start_time = time.perf_counter()
+  stream_input(A, M, N, w, h, io_halo, send_band, args.stream_band)
+else:
+  A_prepared = tile_input(A, M, N, w, h, io_halo)
+  start_time = time.perf_counter()
+  send_band(A_prepared, 0, h)
+
+if args.interior_io:
+  runner.launch('unpack', nonblock=False)
 
 # Load coefficients
-runner.memcpy_h2d(coeff_symbol, c_tiled, 0, 0, w, h, len(coefficients), streaming=False,
-  order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+if not streamed:
+  runner.memcpy_h2d(coeff_symbol, c_tiled, 0, 0, w, h, len(coefficients), streaming=False,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
 
 start_time_compute = time.perf_counter()
 
 # Launch program
-runner.launch('compute', nonblock=False)
+if streamed:
+  # already running since the tiles arrived
+  wait_done(runner, d2h_color, w, h, iterations)
+elif snapshot > 0:
+  # the kernel pauses every snapshot iterations until it is resumed: the
+  # writer threads store snapshots and checkpoints while the device computes
+  def read_state(buf):
+    if args.interior_io:
+      runner.launch('pack', nonblock=False)
+    runner.memcpy_d2h(buf, io_symbol, 0, 0, w, h, io_elements, streaming=False,
+      order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+
+  def read_iter():
+    counters = np.zeros(w*h, dtype=np.int32)
+    runner.memcpy_d2h(counters, iter_symbol, 0, 0, w, h, 1, streaming=False,
+      order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+    return counters
+
+  frames = len(pause_iterations(start_iter, iterations, snapshot))
+  snapshots = snapshot_writer(args.snapshot_file, frames, M, N, w, h, io_halo, fields) if args.snapshot_file else None
+  checkpoints = checkpoint_writer(args.checkpoint_dir, ckpt_meta, args.checkpoint_keep) if args.checkpoint_dir else None
+
+  drive_pauses(lambda f: runner.launch(f, nonblock=False), read_state, read_iter, start_iter, iterations, snapshot,
+    snapshots, checkpoints, args.checkpoint_every, args.checkpoint_overhead)
+else:
+  runner.launch('compute', nonblock=False)
 
 end_time_compute = time.perf_counter()
 
-# Retrieve result
-y_result = np.zeros(elements_per_PE*h*w, dtype=np.float32)
-runner.memcpy_d2h(y_result, A_symbol, 0, 0, w, h, elements_per_PE, streaming=False,
-  order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+# Retrieve result: with --decimate-mode only A_dec is read back, unless the
+# full grid (or the ROI) is needed to verify
+read_result = not args.decimate_mode or args.roi or verify or args.verify_sample
+
+if read_result and args.interior_io:
+  runner.launch('pack', nonblock=False)
+
+# only the PEs holding the ROI, if any
+x0, y0, pw, ph = roi_pes(M, N, w, h, args.roi) if args.roi else (0, 0, w, h)
+if not read_result:
+  y_result = None
+elif streamed:
+  y_result = np.zeros(io_elements*pw*ph, dtype=np.float32)
+  runner.launch('send_result', nonblock=False)
+  runner.memcpy_d2h(y_result, d2h_color, x0, y0, pw, ph, io_elements, streaming=True,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+else:
+  y_result = np.zeros(io_elements*pw*ph, dtype=np.float32)
+  runner.memcpy_d2h(y_result, io_symbol, x0, y0, pw, ph, io_elements, streaming=False,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+
+# Retrieve decimated output
+if args.decimate_mode:
+  if(decimate <= 0):
+    raise Exception(f'Program "{args.name}" was not compiled with decimate > 0!')
+
+  runner.launch(f'decimate_{args.decimate_mode}', nonblock=False)
+
+  dec_elements = (pe_M // decimate) * (pe_N // decimate)
+  y_dec = np.zeros(dec_elements*w*h, dtype=np.float32)
+  runner.memcpy_d2h(y_dec, runner.get_id('A_dec'), 0, 0, w, h, dec_elements, streaming=False,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
 
 # Retrieve timings
 tsc = np.zeros((w*h*3), dtype=np.uint32)
@@ -81,17 +211,38 @@ end_time = time.perf_counter()
 
 runner.stop()
 
+if snapshot > 0:
+  for writer in (snapshots, checkpoints):
+    if writer is not None: writer.close()
+  if snapshots is not None:
+    print(f'Snapshots: {frames} frames every {snapshot} iterations in {args.snapshot_file}')
+
 ####################
 ##  Check Result  ##
 ####################
 
-if verify:
+if args.roi:
+
+  y_result = untile_roi(y_result, M, N, w, h, io_halo, args.roi)
+
+  if verify or args.verify_sample:
+    check_roi_result(A, y_result, M, N, coefficients, "box2d", radius, iterations, args.roi)
+
+elif verify or args.verify_sample:
+
+  y_result = untile_result(y_result, M, N, w, h, io_halo, fields=fields)
+
+  check_result(A, y_result, M, N, coefficients, "box2d", radius, iterations, args.reference,
+    sample=args.verify_sample, kernel_dims=(w, h), cache_dir=args.ref_cache, cache_size=args.ref_cache_size*1e9,
+    cache_every=args.ref_cache_every)
+
+if args.decimate_mode:
 
-  y_result = y_result.reshape(w, h, *tiled_shape)
-  y_result = y_result[:,:, radius:-radius, radius:-radius].transpose(0, 2, 1, 3)
-  y_result = y_result.reshape(M+pad_x, N+pad_y)[:M,:N].ravel()
+  y_dec = untile_decimated(y_dec, M, N, w, h, decimate)
 
-  check_result(A, y_result, M, N, coefficients, "box2d", radius, iterations)
+  if verify:
+    check_decimated_result(A, y_dec, M, N, coefficients, "box2d", radius, iterations,
+      w, h, decimate, args.decimate_mode, args.reference)
 
 
 ###################
@@ -100,7 +251,7 @@ if verify:
 
 cycles = parse_tsc(w, h, tsc.view(np.float32).reshape((h, w, 3)))
 time_device = cycles["max"] / (875e6)
-GStencil = (M * N * iterations) / time_device * 10e-9
+GStencil = (M * N * iterations * fields) / time_device * 10e-9
 
 time_h2d = start_time_compute - start_time
 time_compute = end_time_compute - start_time_compute
@@ -108,8 +259,11 @@ time_d2h = end_time - end_time_compute
 time_total = end_time - start_time
 
 print(f'Time (device): {time_device} s')
+print(f'Memcpy mode: {args.memcpy_mode}')
 print(f'GStencil/s: {GStencil}')
 print(f'{w},{h},{M},{N},{iterations},{time_h2d},{time_compute},{time_d2h},{time_total},{GStencil},{time_device}')
 
-with open(f"box2d-{radius}r.csv", "a") as f:
+# streaming mode results are kept apart from the copy mode ones
+csv_suffix = "-stream" if streamed else ""
+with open(f"box2d-{radius}r{csv_suffix}.csv", "a") as f:
   f.write(f'{w},{h},{M},{N},{iterations},{time_h2d},{time_compute},{time_d2h},{time_total},{GStencil},{time_device}\n')
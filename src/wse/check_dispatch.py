@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+'''
+  Checks dispatch.py on two local fake endpoints whose every 2nd run fails
+  (--fail-every 2), over jobs of two artifacts:
+  - with enough retries every job ends up in results.jsonl exactly once, done,
+    with its downloaded output
+  - a second dispatch on the same store skips the completed jobs
+  - with --retries 0 the failed jobs are recorded once each and the exit
+    status is nonzero
+'''
+here = os.path.dirname(os.path.abspath(__file__))
+
+def dispatch(jobs_path, store, retries):
+  return subprocess.run([sys.executable, os.path.join(here, "dispatch.py"), "--jobs", jobs_path, "--store", store,
+    "--fake", "2", "--fail-every", "2", "--retries", str(retries), "--backoff", "0"], capture_output=True, text=True)
+
+def results(store):
+  with open(os.path.join(store, "results.jsonl"), "r", encoding="utf8") as f:
+    return [json.loads(line) for line in f]
+
+def check_once(records, jobs, status=None):
+  ids = [r["id"] for r in records]
+  if(sorted(ids) != sorted(job["id"] for job in jobs)):
+    raise Exception(f'Expected every job once in results.jsonl, got {ids}!')
+  if status is not None and any(r["status"] != status for r in records):
+    raise Exception(f'Expected every job {status}, got {records}!')
+
+if __name__ == "__main__":
+  with tempfile.TemporaryDirectory() as tmp:
+    jobs = []
+    for a in ("a", "b"):
+      os.makedirs(os.path.join(tmp, a))
+      jobs += [{"id": f"{a}{i}", "artifact": os.path.join(tmp, a), "command": f"echo {a}{i} > {a}{i}.txt",
+                "outputs": [f"{a}{i}.txt"]} for i in range(4)]
+
+    jobs_path = os.path.join(tmp, "jobs.json")
+    with open(jobs_path, "w", encoding="utf8") as f:
+      json.dump(jobs, f)
+
+    # retries enough for every job
+    store = os.path.join(tmp, "results")
+    done = dispatch(jobs_path, store, retries=len(jobs))
+    if(done.returncode != 0):
+      raise Exception(f'Dispatch failed: {done.stdout}{done.stderr}')
+    if "failed on" not in done.stdout:
+      raise Exception('No run failed, the retry path was not taken!')
+    check_once(results(store), jobs, "done")
+    for job in jobs:
+      with open(os.path.join(store, job["id"], f'{job["id"]}.txt'), "r", encoding="utf8") as f:
+        if(f.read().strip() != job["id"]):
+          raise Exception(f'Wrong output of job {job["id"]}!')
+
+    # completed jobs are skipped
+    done = dispatch(jobs_path, store, retries=len(jobs))
+    if(done.returncode != 0 or "done on" in done.stdout):
+      raise Exception(f'Completed jobs were run again: {done.stdout}{done.stderr}')
+    check_once(results(store), jobs, "done")
+
+    # retries run out
+    store = os.path.join(tmp, "results-no-retries")
+    done = dispatch(jobs_path, store, retries=0)
+    if(done.returncode == 0):
+      raise Exception('Dispatch without retries exited with 0 after failed runs!')
+    records = results(store)
+    check_once(records, jobs)
+    if not any(r["status"] == "failed" for r in records):
+      raise Exception('No job recorded as failed!')
+
+  print("SUCCESS!")
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import fcntl
+import glob
+import hashlib
+import importlib.metadata
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+'''
+  Content-addressed cache of compiled programs: the key hashes the CSL
+  sources (every .csl file of the given directories), the compile options
+  (arch, fabric dims and offsets, params, channels) and the compiler version,
+  so a host-only change compiles nothing and an SDK upgrade recompiles. An
+  entry holds the cslc output directory, or the artifact of an appliance
+  compile (a copy if it is a local file, else its path). Hits and misses are counted in stats.json, the least recently used
+  entries are evicted beyond max_bytes. Concurrent compiles (make -j) share
+  the cache: every change of it is made under a lock on <root>/lock, and the
+  JSON files are replaced atomically.
+
+  Location and size: $COMPILE_CACHE_DIR (default build/compile-cache) and
+  $COMPILE_CACHE_SIZE in GB (default 20). COMPILE_CACHE=0 disables it.
+  $COMPILE_CACHE_TAG is added to the key, e.g. the SDK image tag of the
+  appliance, whose compiler version the client cannot see.
+'''
+default_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "build", "compile-cache")
+
+class CompileCache:
+
+  def __init__(self, root=None, max_bytes=None):
+    self.root = root or os.environ.get("COMPILE_CACHE_DIR", default_dir)
+    self.max_bytes = max_bytes if max_bytes is not None else float(os.environ.get("COMPILE_CACHE_SIZE", 20)) * 1e9
+    self.enabled = os.environ.get("COMPILE_CACHE", "1") != "0"
+    self.lock_file = None
+    os.makedirs(self.root, exist_ok=True)
+
+  # compiler: cslc_version() or sdk_version()
+  def key(self, sources, options, compiler):
+    digest = hashlib.sha256()
+    for path in source_files(sources):
+      digest.update(os.path.basename(path).encode())
+      with open(path, "rb") as f:
+        digest.update(hashlib.sha256(f.read()).digest())
+    digest.update(options.encode())
+    digest.update(compiler.encode())
+    digest.update(os.environ.get("COMPILE_CACHE_TAG", "").encode())
+    return digest.hexdigest()
+
+  # cslc output directory: copied to out on a hit
+  def fetch_dir(self, key, out):
+    with self._lock():
+      entry = self._hit(key, "out")
+      if entry is None: return False
+
+      if os.path.isdir(out): shutil.rmtree(out)
+      shutil.copytree(os.path.join(entry, "out"), out)
+    return True
+
+  def store_dir(self, key, out):
+    if not self.enabled: return
+    with self._lock():
+      entry = self._entry_dir(key)
+      shutil.copytree(out, os.path.join(entry, "out"), dirs_exist_ok=True)
+      self._store(key, entry, dict(kind="out"))
+
+  # appliance artifact: the cached path on a hit
+  def fetch_artifact(self, key):
+    with self._lock():
+      entry = self._hit(key, "artifact")
+      if entry is None: return None
+
+      with open(os.path.join(entry, "entry.json"), "r", encoding="utf8") as f:
+        return json.load(f)["artifact_path"]
+
+  def store_artifact(self, key, artifact_path):
+    if not self.enabled: return
+    with self._lock():
+      entry = self._entry_dir(key)
+      if os.path.isfile(artifact_path):
+        shutil.copy(artifact_path, entry)
+        artifact_path = os.path.join(os.path.abspath(entry), os.path.basename(artifact_path))
+      self._store(key, entry, dict(kind="artifact", artifact_path=artifact_path))
+
+  def stats(self):
+    path = os.path.join(self.root, "stats.json")
+    stats = dict(hits=0, misses=0, evictions=0)
+    with self._lock():
+      if os.path.exists(path):
+        with open(path, "r", encoding="utf8") as f:
+          stats.update(json.load(f))
+
+      entries = self._entries()
+    stats.update(entries=len(entries), bytes=sum(size for _, size, _ in entries))
+    return stats
+
+  def clear(self):
+    with self._lock():
+      for key, _, _ in self._entries():
+        shutil.rmtree(os.path.join(self.root, key))
+
+  # exclusive lock of the cache, held by this process once (nested uses are free)
+  @contextlib.contextmanager
+  def _lock(self):
+    if self.lock_file is not None:
+      yield
+      return
+
+    with open(os.path.join(self.root, "lock"), "w", encoding="utf8") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      self.lock_file = f
+      try:
+        yield
+      finally:
+        self.lock_file = None
+
+  # called with the lock held
+  def _hit(self, key, kind):
+    entry = os.path.join(self.root, key)
+    meta = os.path.join(entry, "entry.json")
+    if not self.enabled or not os.path.exists(meta):
+      self._count("misses")
+      return None
+
+    with open(meta, "r", encoding="utf8") as f:
+      data = json.load(f)
+    if(data["kind"] != kind):
+      self._count("misses")
+      return None
+
+    data["used"] = time.time()
+    write_json(meta, data)
+    self._count("hits")
+    return entry
+
+  def _entry_dir(self, key):
+    entry = os.path.join(self.root, key)
+    os.makedirs(entry, exist_ok=True)
+    return entry
+
+  def _store(self, key, entry, data):
+    data.update(used=time.time(), bytes=tree_size(entry))
+    write_json(os.path.join(entry, "entry.json"), data)
+    self._evict(keep=key)
+
+  # least recently used first, never the entry just stored
+  def _evict(self, keep):
+    entries = sorted(self._entries(), key=lambda e: e[2])
+    total = sum(size for _, size, _ in entries)
+    for key, size, _ in entries:
+      if(total <= self.max_bytes): break
+      if(key == keep): continue
+      shutil.rmtree(os.path.join(self.root, key))
+      total -= size
+      self._count("evictions")
+
+  # (key, bytes, last use) of the complete entries
+  def _entries(self):
+    entries = []
+    for meta in glob.glob(os.path.join(self.root, "*", "entry.json")):
+      with open(meta, "r", encoding="utf8") as f:
+        data = json.load(f)
+      entries.append((os.path.basename(os.path.dirname(meta)), data["bytes"], data["used"]))
+    return entries
+
+  def _count(self, name):
+    with self._lock():
+      path = os.path.join(self.root, "stats.json")
+      stats = {}
+      if os.path.exists(path):
+        with open(path, "r", encoding="utf8") as f:
+          stats = json.load(f)
+      stats[name] = stats.get(name, 0) + 1
+      write_json(path, stats)
+
+# written next to path, then renamed over it: readers never see a partial file
+def write_json(path, data):
+  tmp_path = f"{path}.{os.getpid()}.tmp"
+  with open(tmp_path, "w", encoding="utf8") as f:
+    json.dump(data, f)
+  os.replace(tmp_path, path)
+
+# `cslc --version` of a local compile
+def cslc_version(cslc="cslc"):
+  try:
+    done = subprocess.run([cslc, "--version"], capture_output=True, text=True)
+  except OSError:
+    return f"{cslc}: not found"
+  return (done.stdout + done.stderr).strip()
+
+# versions of the installed SDK client packages, for an appliance compile
+def sdk_version():
+  dists = importlib.metadata.packages_distributions().get("cerebras", [])
+  return ",".join(sorted(f"{d}=={importlib.metadata.version(d)}" for d in set(dists)))
+
+def source_files(sources):
+  files = []
+  for path in sources:
+    if os.path.isdir(path):
+      files += sorted(glob.glob(os.path.join(path, "*.csl")))
+    else:
+      files.append(path)
+  return files
+
+def tree_size(path):
+  return sum(os.path.getsize(os.path.join(d, f)) for d, _, names in os.walk(path) for f in names)
+
+'''
+  compile: runs a cslc command line (after --) unless the cache holds its
+  output directory, e.g.
+    compile_cache.py compile --out out --sources . -- cslc layout.csl ... -o out
+  The --out path is left out of the key.
+'''
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Content-addressed cache of compiled CSL programs.")
+  sub = parser.add_subparsers(dest="action", required=True)
+
+  compile_parser = sub.add_parser("compile", help="Compile unless cached")
+  compile_parser.add_argument("--out", required=True, help="output directory of the compile (cslc -o)")
+  compile_parser.add_argument("--sources", nargs="+", required=True, help="CSL files, or directories of .csl files")
+  compile_parser.add_argument("command", nargs=argparse.REMAINDER, help="-- the compile command line")
+  sub.add_parser("stats", help="Print the hit/miss statistics and size of the cache")
+  sub.add_parser("clear", help="Remove every entry")
+
+  args = parser.parse_args()
+  cache = CompileCache()
+
+  if args.action == "compile":
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    options = " ".join("<out>" if arg == args.out else arg for arg in command)
+    key = cache.key(args.sources, options, cslc_version(command[0]))
+
+    if cache.fetch_dir(key, args.out):
+      print(f"Compile cache hit {key[:12]}: {args.out}")
+    else:
+      print(f"Compile cache miss {key[:12]}: compiling")
+      done = subprocess.run(command)
+      if(done.returncode != 0): sys.exit(done.returncode)
+      cache.store_dir(key, args.out)
+  elif args.action == "stats":
+    print(json.dumps(cache.stats()))
+  else:
+    cache.clear()
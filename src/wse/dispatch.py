@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+'''
+  Runs queued (artifact, job) pairs on a pool of appliance endpoints at once.
+  A free endpoint takes the oldest job of the artifact it has open, if any,
+  so the artifact is transferred once per endpoint, otherwise the oldest job.
+  Each result is written to the result store as soon as it is downloaded. A
+  failed job is queued again (up to retries) for the next free endpoint, the
+  endpoint that failed backs off and is dropped after max_failures failures
+  in a row.
+
+  A job (jobs file, JSON list) is
+    {"id": "star2d-1r", "artifact": "star2d/artifact_path.json",
+     "stage": ["star2d/run.py", "star2d/utils.py"],
+     "command": "cs_python run.py --name out --arch wse3 --cmaddr %CMADDR%",
+     "outputs": ["star2d-1r.csv"]}
+  with "artifact" the artifact path, or the artifact_path.json written by
+  appliance_compile.py. check_dispatch.py checks the dispatch on fake
+  endpoints.
+'''
+
+# one appliance, reached through the SDK launcher: options are SdkLauncher
+# keyword arguments (e.g. the appliance of a multi-system setup)
+class ApplianceEndpoint:
+
+  def __init__(self, name, simulator=False, **options):
+    self.name = name
+    self.simulator = simulator
+    self.options = options
+
+  def open(self, artifact_path):
+    from cerebras.sdk.client import SdkLauncher # type: ignore # pylint: disable=import-error
+    return SdkLauncher(artifact_path, simulator=self.simulator, disable_version_check=True, **self.options)
+
+'''
+  Local stand-in for an appliance, with the launcher calls used by
+  appliance_run.py: the artifact (a directory) is copied into a scratch
+  working directory, stage copies a file there, run executes the command in
+  it and download_artifact copies a file back. fail_every > 0 makes every
+  k-th run raise, to go through the retry path.
+'''
+class FakeEndpoint:
+
+  def __init__(self, name, cmaddr="localhost:9000", fail_every=0):
+    self.name = name
+    self.cmaddr = cmaddr
+    self.fail_every = fail_every
+    self.runs = 0
+
+  def open(self, artifact_path):
+    return FakeLauncher(self, artifact_path)
+
+class FakeLauncher:
+
+  def __init__(self, endpoint, artifact_path):
+    self.endpoint = endpoint
+    self.artifact_path = artifact_path
+    self.workdir = None
+
+  def __enter__(self):
+    self.workdir = tempfile.mkdtemp(prefix=f"{self.endpoint.name}-")
+    if os.path.isdir(self.artifact_path):
+      shutil.copytree(self.artifact_path, self.workdir, dirs_exist_ok=True)
+    return self
+
+  def __exit__(self, *exc):
+    shutil.rmtree(self.workdir, ignore_errors=True)
+
+  def stage(self, path):
+    shutil.copy(path, self.workdir)
+
+  def run(self, command):
+    self.endpoint.runs += 1
+    if(self.endpoint.fail_every > 0 and self.endpoint.runs % self.endpoint.fail_every == 0):
+      raise RuntimeError(f'Endpoint {self.endpoint.name} failed on run {self.endpoint.runs}!')
+
+    done = subprocess.run(command.replace("%CMADDR%", self.endpoint.cmaddr), shell=True, cwd=self.workdir,
+      capture_output=True, text=True)
+    if(done.returncode != 0):
+      raise RuntimeError(f'"{command}" exited with {done.returncode}: {done.stderr.strip()}')
+    return done.stdout
+
+  def download_artifact(self, name, dest):
+    shutil.copy(os.path.join(self.workdir, name), dest)
+
+'''
+  Shared result store: <root>/<job id>/ holds the downloaded outputs and the
+  response of the run, <root>/results.jsonl one line per finished or failed
+  job. Jobs already done in the store are skipped by a later dispatch.
+'''
+class ResultStore:
+
+  def __init__(self, root):
+    self.root = root
+    self.log = os.path.join(root, "results.jsonl")
+    os.makedirs(root, exist_ok=True)
+
+  def done(self):
+    if not os.path.exists(self.log):
+      return set()
+    with open(self.log, "r", encoding="utf8") as f:
+      return {r["id"] for r in map(json.loads, f) if r["status"] == "done"}
+
+  def job_dir(self, job):
+    path = os.path.join(self.root, job["id"])
+    os.makedirs(path, exist_ok=True)
+    return path
+
+  def put(self, job, endpoint, response, seconds):
+    with open(os.path.join(self.job_dir(job), "response.txt"), "w", encoding="utf8") as f:
+      f.write(str(response))
+    self._append(dict(id=job["id"], status="done", endpoint=endpoint, attempts=job["attempts"], seconds=seconds))
+
+  def fail(self, job, error):
+    self._append(dict(id=job["id"], status="failed", attempts=job["attempts"], error=str(error)))
+
+  def _append(self, record):
+    with open(self.log, "a", encoding="utf8") as f:
+      f.write(json.dumps(record) + "\n")
+
+def artifact_of(job):
+  artifact = job["artifact"]
+  if artifact.endswith(".json"):
+    with open(artifact, "r", encoding="utf8") as f:
+      return json.load(f)["artifact_path"]
+  return artifact
+
+class Dispatcher:
+
+  def __init__(self, endpoints, store, retries=2, backoff=5.0, max_failures=3):
+    self.endpoints = endpoints
+    self.store = store
+    self.retries = retries
+    self.backoff = backoff
+    self.max_failures = max_failures
+
+  async def run(self, jobs):
+    done = self.store.done()
+    self.pending = [dict(job, attempts=0, artifact_path=artifact_of(job)) for job in jobs if job["id"] not in done]
+    self.running = 0
+    self.failed = []
+    self.changed = asyncio.Condition()
+
+    await asyncio.gather(*(self._worker(endpoint) for endpoint in self.endpoints))
+
+    # left over when every endpoint was dropped
+    for job in self.pending:
+      self.store.fail(job, "no endpoint left")
+      self.failed.append(job["id"])
+    return self.failed
+
+  # the oldest job of the open artifact, else the oldest job; waits while
+  # running jobs may still be queued again, None once there is nothing left
+  async def _take(self, artifact_path):
+    async with self.changed:
+      await self.changed.wait_for(lambda: self.pending or self.running == 0)
+      if not self.pending:
+        return None
+
+      job = next((j for j in self.pending if j["artifact_path"] == artifact_path), self.pending[0])
+      self.pending.remove(job)
+      self.running += 1
+      return job
+
+  async def _finish(self, job=None):
+    async with self.changed:
+      self.running -= 1
+      if job is not None:
+        self.pending.append(job)
+      self.changed.notify_all()
+
+  def _run_job(self, launcher, job):
+    for path in job.get("stage", []):
+      launcher.stage(path)
+    response = launcher.run(job["command"])
+    for name in job.get("outputs", []):
+      launcher.download_artifact(name, self.store.job_dir(job))
+    return response
+
+  async def _worker(self, endpoint):
+    session, launcher, artifact_path = None, None, None
+    failures = 0
+
+    async def close():
+      if session is not None:
+        try:
+          await asyncio.to_thread(session.__exit__, None, None, None)
+        except Exception:
+          pass
+
+    while True:
+      job = await self._take(artifact_path)
+      if job is None: break
+
+      try:
+        if(job["artifact_path"] != artifact_path):
+          await close()
+          session, artifact_path = None, None
+          # closed only once entered
+          opened = endpoint.open(job["artifact_path"])
+          launcher = await asyncio.to_thread(opened.__enter__)
+          session, artifact_path = opened, job["artifact_path"]
+
+        start = time.perf_counter()
+        response = await asyncio.to_thread(self._run_job, launcher, job)
+        job["attempts"] += 1
+        self.store.put(job, endpoint.name, response, time.perf_counter() - start)
+        print(f'{job["id"]}: done on {endpoint.name} ({job["attempts"]} attempts)')
+        failures = 0
+        await self._finish()
+      except Exception as e:
+        await close()
+        session, launcher, artifact_path = None, None, None
+        job["attempts"] += 1
+        failures += 1
+        print(f'{job["id"]}: attempt {job["attempts"]} failed on {endpoint.name}: {e}')
+
+        if(job["attempts"] > self.retries):
+          self.store.fail(job, e)
+          self.failed.append(job["id"])
+          await self._finish()
+        else:
+          await self._finish(job)
+
+        if(failures >= self.max_failures):
+          print(f'{endpoint.name}: dropped after {failures} failures in a row')
+          break
+        await asyncio.sleep(self.backoff * failures)
+
+    await close()
+
+def read_endpoints(path):
+  with open(path, "r", encoding="utf8") as f:
+    specs = json.load(f)
+
+  endpoints = []
+  for spec in specs:
+    spec = dict(spec)
+    if spec.pop("fake", False):
+      endpoints.append(FakeEndpoint(**spec))
+    else:
+      endpoints.append(ApplianceEndpoint(spec.pop("name"), spec.pop("simulator", False), **spec.pop("options", {})))
+  return endpoints
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Dispatch queued (artifact, job) pairs to a pool of appliance endpoints.")
+  parser.add_argument("--jobs", required=True, help="JSON list of the jobs")
+  parser.add_argument("--endpoints", default=None, help='JSON list of the endpoints: {"name", "simulator", "options"}, or {"name", "fake": true}')
+  parser.add_argument("--fake", type=int, default=0, metavar="N", help="Use N local fake endpoints instead")
+  parser.add_argument("--fail-every", type=int, default=0, metavar="K", help="Every K-th run of a fake endpoint fails")
+  parser.add_argument("--store", default="results", help="directory of the result store")
+  parser.add_argument("--retries", type=int, default=2, help="Retries of a failed job")
+  parser.add_argument("--backoff", type=float, default=5.0, help="Seconds an endpoint waits after a failure (times the failures in a row)")
+  parser.add_argument("--max-failures", type=int, default=3, help="Failures in a row after which an endpoint is dropped")
+  args = parser.parse_args()
+
+  if args.fake > 0:
+    endpoints = [FakeEndpoint(f"fake{i}", fail_every=args.fail_every) for i in range(args.fake)]
+  elif args.endpoints:
+    endpoints = read_endpoints(args.endpoints)
+  else:
+    raise Exception('Give the endpoints (--endpoints) or a number of fake ones (--fake)!')
+
+  with open(args.jobs, "r", encoding="utf8") as f:
+    jobs = json.load(f)
+
+  dispatcher = Dispatcher(endpoints, ResultStore(args.store), args.retries, args.backoff, args.max_failures)
+  start = time.perf_counter()
+  failed = asyncio.run(dispatcher.run(jobs))
+
+  print(f'{len(jobs) - len(failed)}/{len(jobs)} jobs done in {time.perf_counter() - start} s on {len(endpoints)} endpoints, results in {args.store}')
+  if failed:
+    raise Exception(f'Failed jobs: {", ".join(failed)}!')
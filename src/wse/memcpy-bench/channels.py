@@ -0,0 +1,62 @@
+import argparse
+import csv
+import math
+import os
+
+'''
+  Picks the memcpy channel count from the measurements of the memcpy
+  benchmark (memcpy-bench.csv, appended by run.py): among the channel counts
+  allowed for the rectangle (at most kernel_dim_y), the one with the shortest
+  transfer time for a run doing h2d copies in and d2h copies out. Each
+  channel count is rated on its measurements of the rectangle shape closest
+  to kernel_dim_x x kernel_dim_y, at the transfer size closest to the
+  program's, per direction. Falls back to 1 channel without measurements.
+'''
+default_csv = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memcpy-bench.csv")
+
+def best_channels(kernel_dim_x, kernel_dim_y, elements, path=default_csv, mode="copy", order="ROW_MAJOR", h2d=1, d2h=1):
+  if not os.path.exists(path):
+    return 1
+
+  with open(path, newline="") as f:
+    rows = [r for r in csv.DictReader(f) if r["mode"] == mode and r["order"] == order and int(r["channels"]) <= kernel_dim_y]
+
+  target = math.log(kernel_dim_x * kernel_dim_y * elements * 4)
+  shape_distance = lambda r: abs(math.log(int(r["w"]) / kernel_dim_x)) + abs(math.log(int(r["h"]) / kernel_dim_y))
+  size_distance = lambda r: abs(math.log(int(r["bytes"])) - target)
+
+  times = {}
+  for channels in {int(r["channels"]) for r in rows}:
+    measured = [r for r in rows if int(r["channels"]) == channels]
+    closest = min(map(shape_distance, measured))
+    measured = [r for r in measured if shape_distance(r) == closest]
+
+    # seconds per byte of a run, from the mean bandwidth of each direction
+    time = 0.0
+    for direction, count in (("h2d", h2d), ("d2h", d2h)):
+      if count == 0: continue
+      same = [r for r in measured if r["direction"] == direction]
+      if not same: break
+      closest = min(map(size_distance, same))
+      gbps = [float(r["GBps"]) for r in same if size_distance(r) == closest]
+      time += count * len(gbps) / sum(gbps)
+    else:
+      times[channels] = time
+
+  if not times:
+    return 1
+
+  # fewer channels on ties
+  return min(sorted(times), key=lambda c: times[c])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Print the memcpy channel count measured to be the fastest.")
+  parser.add_argument("--kernel-dim-x", type=int, required=True, help="Kernel dimension in X")
+  parser.add_argument("--kernel-dim-y", type=int, required=True, help="Kernel dimension in Y")
+  parser.add_argument("--elements", type=int, required=True, help="Elements transferred per PE")
+  parser.add_argument("--csv", default=default_csv, help="memcpy benchmark results")
+  parser.add_argument("--h2d", type=int, default=1, help="h2d copies of a run")
+  parser.add_argument("--d2h", type=int, default=1, help="d2h copies of a run (e.g. 1 + the snapshots)")
+  args = parser.parse_args()
+
+  print(best_channels(args.kernel_dim_x, args.kernel_dim_y, args.elements, args.csv, h2d=args.h2d, d2h=args.d2h))
@@ -0,0 +1,36 @@
+#!/bin/bash
+: "${kernel_dim_x:=4}"
+: "${kernel_dim_y:=4}"
+: "${size:=4096}"
+: "${channel_counts:=1 2 4}"
+: "${arch:=wse3}"
+
+fabric_dim_x=$((7 + kernel_dim_x))
+fabric_dim_y=$((2 + kernel_dim_y))
+
+# channels are a compile option: one compile + sweep per channel count
+run_worker() {
+    for channels in $channel_counts; do
+        if (( channels > kernel_dim_y )); then continue; fi
+
+        # compiled only if the CSL sources or the options changed
+        python3 ../compile_cache.py compile --out out --sources . -- \
+        cslc --arch=$arch layout.csl \
+        --fabric-dims=$fabric_dim_x,$fabric_dim_y \
+        --fabric-offsets=4,1 \
+        --params=kernel_dim_x:$kernel_dim_x,kernel_dim_y:$kernel_dim_y,size:$size \
+        -o out --memcpy --channels $channels
+
+        echo ""
+        echo "Running memcpy benchmark with kernel: ${kernel_dim_x}x${kernel_dim_y}, elements per PE: ${size}, channels: ${channels}"
+
+        cs_python run.py --name "out" --arch=$arch --channels $channels
+    done
+}
+
+# If script is sourced, don't auto-run
+# If executed directly, run the function
+if [[ "${BASH_SOURCE[0]}" == "$0" ]]; then
+    set -eu  # Only apply strict mode when run directly
+    run_worker
+fi
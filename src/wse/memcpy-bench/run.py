@@ -0,0 +1,103 @@
+#!/usr/bin/env cs_python
+
+import argparse
+import csv
+import json
+import os
+import time
+import numpy as np
+
+from cerebras.sdk.runtime.sdkruntimepybind import SdkRuntime, MemcpyDataType, MemcpyOrder # type: ignore # pylint: disable=no-name-in-module
+
+'''
+  Sweeps h2d/d2h memcpy bandwidth over PE rectangle shapes, elements per PE,
+  ROW_MAJOR/COL_MAJOR order and copy/streaming mode, for the channel count the
+  program was compiled with. Results are appended to a csv read by channels.py.
+'''
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', help="the test compile output dir")
+parser.add_argument('--arch', help="the simulation target architecture")
+parser.add_argument('--cmaddr', help="IP:port for CS system")
+parser.add_argument("--channels", type=int, required=True, help="channels the program was compiled with")
+parser.add_argument("--reps", type=int, default=5, help="repetitions of each transfer (median is kept)")
+parser.add_argument("--modes", default="copy,stream", help="memcpy modes to sweep")
+parser.add_argument("--out", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "memcpy-bench.csv"), help="csv of the results")
+args = parser.parse_args()
+
+with open(f"{args.name}/out.json", "r", encoding="utf8") as f:
+    data = json.load(f)
+
+w = int(data['params']['kernel_dim_x'])
+h = int(data['params']['kernel_dim_y'])
+size = int(data['params']['size'])
+h2d_color = int(data['params'].get('MEMCPYH2D_DATA_1_ID', 0))
+d2h_color = int(data['params'].get('MEMCPYD2H_DATA_1_ID', 1))
+
+# full rectangle, halves, single row / column
+shapes = sorted({(w, h), (w, max(1, h//2)), (max(1, w//2), h), (max(1, w//2), max(1, h//2)), (w, 1), (1, h)}, reverse=True)
+sizes = sorted({min(1 << k, size) for k in range(6, 15)} | {size})
+orders = {"ROW_MAJOR": MemcpyOrder.ROW_MAJOR, "COL_MAJOR": MemcpyOrder.COL_MAJOR}
+modes = args.modes.split(",")
+
+runner = SdkRuntime(args.name, cmaddr=args.cmaddr)
+
+runner.load()
+runner.run()
+
+buf_symbol = runner.get_id('buf')
+n_symbol = runner.get_id('n')
+
+def timed(fn):
+  times = []
+  for _ in range(args.reps):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  return float(np.median(times))
+
+def h2d(mode, order, x, y, pw, ph, elems, buf):
+  if(mode == "copy"):
+    runner.memcpy_h2d(buf_symbol, buf, x, y, pw, ph, elems, streaming=False,
+      order=order, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+  else:
+    runner.memcpy_h2d(h2d_color, buf, x, y, pw, ph, elems, streaming=True,
+      order=order, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+
+def d2h(mode, order, x, y, pw, ph, elems, buf):
+  if(mode == "copy"):
+    runner.memcpy_d2h(buf, buf_symbol, x, y, pw, ph, elems, streaming=False,
+      order=order, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+  else:
+    runner.launch('send_stream', nonblock=False)
+    runner.memcpy_d2h(buf, d2h_color, x, y, pw, ph, elems, streaming=True,
+      order=order, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+
+results = []
+for pw, ph in shapes:
+  for elems in sizes:
+    buf = np.arange(pw*ph*elems, dtype=np.float32)
+    nbytes = buf.nbytes
+
+    # only the benchmarked PEs stream their buffer out
+    n = np.zeros((h, w), dtype=np.int32)
+    n[:ph, :pw] = elems
+    runner.memcpy_h2d(n_symbol, n.ravel(), 0, 0, w, h, 1, streaming=False,
+      order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+
+    for mode in modes:
+      for order_name, order in orders.items():
+        t_h2d = timed(lambda: h2d(mode, order, 0, 0, pw, ph, elems, buf))
+        t_d2h = timed(lambda: d2h(mode, order, 0, 0, pw, ph, elems, buf))
+
+        for direction, t in (("h2d", t_h2d), ("d2h", t_d2h)):
+          results.append((args.channels, pw, ph, elems, order_name, mode, direction, nbytes, t, nbytes / t / 1e9))
+          print(f'{args.channels},{pw},{ph},{elems},{order_name},{mode},{direction},{nbytes},{t},{nbytes / t / 1e9}')
+
+runner.stop()
+
+new_file = not os.path.exists(args.out)
+with open(args.out, "a", newline="") as f:
+  writer = csv.writer(f)
+  if new_file:
+    writer.writerow(["channels", "w", "h", "elements", "order", "mode", "direction", "bytes", "seconds", "GBps"])
+  writer.writerows(results)
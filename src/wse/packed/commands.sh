@@ -0,0 +1,54 @@
+#!/bin/bash
+: "${jobs:=jobs}"
+: "${tile:=8}"
+: "${iterations:=3}"
+: "${channels:=1}"
+: "${arch:=wse3}"
+
+make_jobs() {
+    # a few independent problems of both shapes and different radii and sizes
+    mkdir -p "$jobs"
+    cs_python - "$jobs" <<'EOF'
+import sys
+import numpy as np
+from utils import generate_input, get_coefficients
+
+for name, shape, radius, M, N in [("a", "star2d", 1, 16, 16), ("b", "star2d", 2, 24, 12),
+                                  ("c", "box2d", 1, 16, 16), ("d", "star2d", 1, 12, 14)]:
+    A = generate_input(M, N, "random", seed=ord(name))
+    np.savez(f"{sys.argv[1]}/{name}.npz", A=A, c=get_coefficients(shape, radius), shape=shape)
+EOF
+}
+
+run_worker() {
+    if [[ ! -d "$jobs" ]]; then
+        make_jobs
+    fi
+
+    # one region per job, packed onto the fabric: writes regions.csl and regions.json
+    cs_python pack.py --jobs "$jobs" --tile $tile
+
+    width=$(python3 -c 'import json; print(json.load(open("regions.json"))["width"])')
+    height=$(python3 -c 'import json; print(json.load(open("regions.json"))["height"])')
+    fabric_dim_x=$((7 + width))
+    fabric_dim_y=$((2 + height))
+
+    # compiled only if the CSL sources or the options changed
+    python3 ../compile_cache.py compile --out out --sources . ../star2d ../box2d -- \
+    cslc --arch=$arch layout.csl \
+    --fabric-dims=$fabric_dim_x,$fabric_dim_y \
+    --fabric-offsets=4,1 \
+    -o out --memcpy --channels $channels
+
+    echo ""
+    echo "Running the jobs of ${jobs} on ${width}x${height} PEs"
+
+    cs_python run.py --name "out" --arch=$arch --jobs "$jobs" --iterations $iterations --verify
+}
+
+# If script is sourced, don't auto-run
+# If executed directly, run the function
+if [[ "${BASH_SOURCE[0]}" == "$0" ]]; then
+    set -eu  # Only apply strict mode when run directly
+    run_worker
+fi
@@ -0,0 +1,199 @@
+#!/usr/bin/env cs_python
+
+import argparse
+import glob
+import json
+import math
+import os
+import numpy as np
+
+from utils import pe_geometry, get_coefficients, star_coefficients, box_coefficients
+
+'''
+  Spatial multiplexing: independent stencil problems, each in its own PE
+  rectangle (region) of one wafer program. plan_regions packs a region per
+  queued job onto the fabric, schedule assigns the queue to the regions in
+  rounds: every region runs one job per round, a region is reused by the
+  later jobs its compiled shape, radius and M x N capacity can hold.
+'''
+SHAPES = ["star2d", "box2d"]
+
+# WSE-3 PEs left to the kernel by the memcpy columns and rows around it
+# (fabric_dim_x = w + 7, fabric_dim_y = h + 2)
+FABRIC = (762 - 7, 1172 - 2)
+
+def region_dims(M, N, radius, tile=64):
+  if(tile < radius):
+    raise Exception(f'A tile of {tile} x {tile} per PE is less than the radius {radius}!')
+  # kernel dims of at least 2 x 2, like layout.csl
+  return max(2, math.ceil(N / tile)), max(2, math.ceil(M / tile))
+
+def pe_fits(shape, radius, pe_M, pe_N):
+  if(pe_M < radius or pe_N < radius): return False
+  # the per PE limits of the star2d and box2d layouts
+  if(shape == "star2d"): return pe_M * pe_N <= 5329
+  return (pe_M + 2*radius) * (pe_N + 2*radius) <= 4900
+
+'''
+  Shelf packing, tallest first: the regions go left to right on shelves as
+  high as their first region, a new shelf starts above the last one. Returns
+  the placed regions (x, y added) and the indices of the specs left out.
+'''
+def plan_regions(specs, fabric=FABRIC):
+  W, H = fabric
+  order = sorted(range(len(specs)), key=lambda i: (-specs[i]["h"], -specs[i]["w"]))
+
+  regions, left = [], []
+  shelves = []  # [y, height, next free x]
+  top = 0
+  for i in order:
+    spec = specs[i]
+    shelf = next((s for s in shelves if spec["h"] <= s[1] and s[2] + spec["w"] <= W), None)
+    if shelf is None:
+      if(top + spec["h"] > H or spec["w"] > W):
+        left.append(i)
+        continue
+      shelf = [top, spec["h"], 0]
+      shelves.append(shelf)
+      top += spec["h"]
+
+    regions.append(dict(spec, x=shelf[2], y=shelf[0]))
+    shelf[2] += spec["w"]
+
+  return regions, left
+
+def region_fits(region, job):
+  if(job["shape"] != region["shape"] or job["radius"] != region["radius"]): return False
+
+  pe_M, pe_N, _, _ = pe_geometry(job["M"], job["N"], region["w"], region["h"])
+  max_M, max_N, _, _ = pe_geometry(region["M"], region["N"], region["w"], region["h"])
+  return pe_M <= max_M and pe_N <= max_N and pe_M >= job["radius"] and pe_N >= job["radius"]
+
+'''
+  Rounds of {region: job}: the jobs are taken in queue order, each by the
+  smallest free region that holds it. Raises if a job fits no region.
+'''
+def schedule(jobs, regions):
+  for k, job in enumerate(jobs):
+    if not any(region_fits(region, job) for region in regions):
+      raise Exception(f'Job {job.get("name", k)} ({job["shape"]}, radius {job["radius"]}, {job["M"]} x {job["N"]}) fits no region!')
+
+  rounds = []
+  pending = list(range(len(jobs)))
+  while pending:
+    free = set(range(len(regions)))
+    assigned, rest = {}, []
+    for k in pending:
+      fits = [r for r in free if region_fits(regions[r], jobs[k])]
+      if fits:
+        r = min(fits, key=lambda r: (regions[r]["w"] * regions[r]["h"], r))
+        assigned[r] = k
+        free.remove(r)
+      else:
+        rest.append(k)
+
+    rounds.append(assigned)
+    pending = rest
+
+  return rounds
+
+'''
+  A queued job is a .npz file with the initial field "A", the coefficients
+  "c" and the stencil "shape"; the radius follows from the coefficients.
+'''
+def job_radius(path, shape, c):
+  # the radii of the coefficient tables of utils.py
+  radii = len(star_coefficients) if shape == "star2d" else len(box_coefficients)
+  for radius in range(1, radii + 1):
+    if(len(get_coefficients(shape, radius)) == len(c)): return radius
+  raise ValueError(f'Job "{path}" has {len(c)} coefficients, no {shape} stencil of radius 1 to {radii}!')
+
+def read_jobs(jobs_dir):
+  jobs = []
+  for path in sorted(glob.glob(os.path.join(jobs_dir, "*.npz"))):
+    job = np.load(path)
+    shape = str(job["shape"])
+    if shape not in SHAPES:
+      raise Exception(f'Job "{path}" has shape "{shape}", not one of {SHAPES}!')
+
+    M, N = job["A"].shape
+    jobs.append(dict(name=os.path.splitext(os.path.basename(path))[0], path=path, shape=shape,
+      radius=job_radius(path, shape, job["c"]), M=M, N=N))
+
+  return jobs
+
+'''
+  regions.json is read by run.py, regions.csl by layout.csl
+'''
+def write_regions(out_dir, regions):
+  width = max(r["x"] + r["w"] for r in regions)
+  height = max(r["y"] + r["h"] for r in regions)
+  keys = ["x", "y", "w", "h", "M", "N", "radius", "shape"]
+
+  with open(os.path.join(out_dir, "regions.json"), "w", encoding="utf8") as f:
+    json.dump(dict(width=width, height=height, regions=[{k: r[k] for k in keys} for r in regions]), f, indent=2)
+
+  def array(key, values):
+    return f'const {key} = [count]i32 {{ {", ".join(str(v) for v in values)} }};'
+
+  lines = [
+    "// Regions of the packed layout, written by pack.py",
+    "",
+    "// bounding box of the regions (PEs)",
+    f"const width: i32 = {width};",
+    f"const height: i32 = {height};",
+    "",
+    f"const count: i32 = {len(regions)};",
+    "",
+    "// origin and PE grid of each region",
+    array("x", [r["x"] for r in regions]),
+    array("y", [r["y"] for r in regions]),
+    array("w", [r["w"] for r in regions]),
+    array("h", [r["h"] for r in regions]),
+    "",
+    "// compiled matrix, radius and shape (0: star2d, 1: box2d) of each region",
+    array("M", [r["M"] for r in regions]),
+    array("N", [r["N"] for r in regions]),
+    array("radius", [r["radius"] for r in regions]),
+    array("shape", [SHAPES.index(r["shape"]) for r in regions]),
+  ]
+  with open(os.path.join(out_dir, "regions.csl"), "w", encoding="utf8") as f:
+    f.write("\n".join(lines) + "\n")
+
+  return width, height
+
+def read_regions(path):
+  with open(path, "r", encoding="utf8") as f:
+    return json.load(f)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description="Pack a region per queued job onto the fabric and write regions.csl / regions.json")
+  parser.add_argument("--jobs", required=True, help="directory of the .npz jobs")
+  parser.add_argument("--out", default=".", help="directory of regions.csl and regions.json (the layout.csl one)")
+  parser.add_argument("--tile", type=int, default=64, help="Matrix rows and columns per PE of each region")
+  parser.add_argument("--fabric", default=f"{FABRIC[0]},{FABRIC[1]}", type=lambda v: tuple(int(x) for x in v.split(",")),
+                      metavar="W,H", help="PEs available to the regions")
+  args = parser.parse_args()
+
+  jobs = read_jobs(args.jobs)
+  if not jobs:
+    raise Exception(f'No .npz jobs in "{args.jobs}"!')
+
+  specs = []
+  for job in jobs:
+    w, h = region_dims(job["M"], job["N"], job["radius"], args.tile)
+    pe_M, pe_N, _, _ = pe_geometry(job["M"], job["N"], w, h)
+    if not pe_fits(job["shape"], job["radius"], pe_M, pe_N):
+      raise Exception(f'Job {job["name"]} needs {pe_M} x {pe_N} per PE with --tile {args.tile}, more than a PE holds!')
+    specs.append(dict(shape=job["shape"], radius=job["radius"], M=job["M"], N=job["N"], w=w, h=h))
+
+  regions, left = plan_regions(specs, args.fabric)
+  if not regions:
+    raise Exception(f'No region fits the {args.fabric[0]} x {args.fabric[1]} fabric!')
+
+  width, height = write_regions(args.out, regions)
+  rounds = schedule(jobs, regions)
+
+  print(f'{len(regions)} regions in {width} x {height} PEs, {len(jobs)} jobs in {len(rounds)} rounds')
+  for r, region in enumerate(regions):
+    print(f'  region {r}: {region["shape"]} radius {region["radius"]}, {region["M"]} x {region["N"]} on {region["w"]} x {region["h"]} PEs at ({region["x"]}, {region["y"]})')
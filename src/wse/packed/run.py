@@ -0,0 +1,134 @@
+#!/usr/bin/env cs_python
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+
+from utils import *
+from pack import read_jobs, read_regions, schedule
+
+from cerebras.sdk.runtime.sdkruntimepybind import SdkRuntime, MemcpyDataType, MemcpyOrder # type: ignore # pylint: disable=no-name-in-module
+
+'''
+  Runs the queued .npz jobs (see pack.py) on a packed program: every round,
+  each region takes one job, copied in and out through the memcpy
+  sub-rectangle of the region, and all the regions compute at once. A job
+  can hold its own "iterations". Results are saved as <job>.npy in the
+  output directory.
+'''
+parser = argparse.ArgumentParser()
+parser.add_argument('--name', help="the test compile output dir")
+parser.add_argument('--arch', help="the simulation target architecture")
+parser.add_argument('--cmaddr', help="IP:port for CS system")
+parser.add_argument("--jobs", required=True, help="directory of the .npz jobs")
+parser.add_argument("--regions", default="regions.json", help="regions of the program, written by pack.py")
+parser.add_argument("--out", default="results", help="directory of the results")
+parser.add_argument("--iterations", type=int, default=None, help="Iterations of the jobs without their own (default: the compiled value)")
+parser.add_argument("--reference", default="auto", choices=["auto", "native", "numpy", "tiled", "parallel"], help="CPU reference backend used by --verify")
+parser.add_argument("--verify", action="store_true", help="Verify each result")
+args = parser.parse_args()
+
+if(args.iterations is not None and args.iterations < 0):
+  raise Exception(f'Iterations must not be negative, not {args.iterations}!')
+
+with open(f"{args.name}/out.json", "r", encoding="utf8") as f:
+  data = json.load(f)
+
+default_iterations = args.iterations if args.iterations is not None else int(data['params'].get('iterations', 1))
+regions = read_regions(args.regions)["regions"]
+jobs = read_jobs(args.jobs)
+rounds = schedule(jobs, regions)
+
+os.makedirs(args.out, exist_ok=True)
+
+runner = SdkRuntime(args.name, cmaddr=args.cmaddr)
+
+runner.load()
+runner.run()
+
+A_symbol = runner.get_id('A')
+coeff_symbol = runner.get_id('c')
+iterations_symbol = runner.get_id('iterations')
+sizes_symbol = runner.get_id('sizes')
+symbol_maxmin_time = runner.get_id("maxmin_time")
+
+# memcpy of the sub-rectangle of a region
+def h2d(symbol, buf, region, elements):
+  runner.memcpy_h2d(symbol, buf, region["x"], region["y"], region["w"], region["h"], elements, streaming=False,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+
+def d2h(buf, symbol, region, elements):
+  runner.memcpy_d2h(buf, symbol, region["x"], region["y"], region["w"], region["h"], elements, streaming=False,
+    order=MemcpyOrder.ROW_MAJOR, data_type=MemcpyDataType.MEMCPY_32BIT, nonblock=False)
+
+start_time = time.perf_counter()
+
+for k, assigned in enumerate(rounds):
+
+  # sizes of every region, then resize (also resets the device state):
+  # a region without a job this round runs one iteration on zeros
+  for r, region in enumerate(regions):
+    job = jobs[assigned[r]] if r in assigned else region
+    sizes = pe_sizes(job["M"], job["N"], region["w"], region["h"], region["M"], region["N"], region["radius"])
+    h2d(sizes_symbol, sizes, region, 4)
+  runner.launch('resize', nonblock=False)
+
+  start_round = time.perf_counter()
+  loaded = {}
+  for r, region in enumerate(regions):
+    if r not in assigned:
+      h2d(iterations_symbol, np.ones(region["w"]*region["h"], dtype=np.int32), region, 1)
+      continue
+
+    job = jobs[assigned[r]]
+    npz = np.load(job["path"])
+    iterations = int(npz["iterations"]) if "iterations" in npz else default_iterations
+    if(iterations <= 0):
+      raise Exception(f'Iterations must be greater than 0, not {iterations}!')
+
+    A = npz["A"].astype(np.float32)
+    c = npz["c"].astype(np.float32)
+    loaded[r] = (A, c, iterations)
+
+    pe_M, pe_N, _, _ = pe_geometry(job["M"], job["N"], region["w"], region["h"])
+    halo = region["radius"]
+    h2d(A_symbol, tile_input(A, job["M"], job["N"], region["w"], region["h"], halo), region, (pe_M + 2*halo) * (pe_N + 2*halo))
+    h2d(coeff_symbol, np.tile(c, region["w"]*region["h"]), region, len(c))
+    h2d(iterations_symbol, np.full(region["w"]*region["h"], iterations, dtype=np.int32), region, 1)
+
+  start_compute = time.perf_counter()
+  runner.launch('compute', nonblock=False)  # every region at once
+  end_compute = time.perf_counter()
+
+  for r, (A, c, iterations) in loaded.items():
+    region, job = regions[r], jobs[assigned[r]]
+    M, N, w, h, halo = job["M"], job["N"], region["w"], region["h"], region["radius"]
+
+    pe_M, pe_N, _, _ = pe_geometry(M, N, w, h)
+    io_elements = (pe_M + 2*halo) * (pe_N + 2*halo)
+    y_result = np.zeros(io_elements*w*h, dtype=np.float32)
+    d2h(y_result, A_symbol, region, io_elements)
+    y_result = untile_result(y_result, M, N, w, h, halo)
+    np.save(os.path.join(args.out, f'{job["name"]}.npy'), y_result)
+
+    tsc = np.zeros((w*h*3), dtype=np.uint32)
+    d2h(tsc, symbol_maxmin_time, region, 3)
+    cycles = parse_tsc(w, h, tsc.view(np.float32).reshape((h, w, 3)))
+    time_device = cycles["max"] / (875e6)
+
+    print(f'{job["name"]},{k},{r},{job["shape"]},{halo},{M},{N},{iterations},{time_device}')
+
+    if args.verify:
+      check_result(A, y_result, M, N, c, job["shape"], halo, iterations, args.reference, kernel_dims=(w, h))
+
+  end_round = time.perf_counter()
+  print(f'Round {k}: {len(assigned)}/{len(regions)} regions, h2d {start_compute - start_round} s, '
+        f'compute {end_compute - start_compute} s, d2h {end_round - end_compute} s')
+
+end_time = time.perf_counter()
+
+runner.stop()
+
+print(f'{len(jobs)} jobs in {len(rounds)} rounds, {end_time - start_time} s, results in {args.out}')
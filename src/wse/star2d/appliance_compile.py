@@ -1,3 +1,5 @@
+import os
+import sys
 import json
 import logging
 import argparse
@@ -5,35 +7,61 @@ import argparse
 from cerebras.sdk.client import SdkCompiler
 from cerebras.appliance import logger
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "memcpy-bench"))
+from channels import best_channels
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from compile_cache import CompileCache, sdk_version
+
 logging.basicConfig(level=logging.INFO)
 
 parser = argparse.ArgumentParser(description="Compile a Cerebras stencil layout with configurable parameters.")
 parser.add_argument("--kernel-dim-x", type=int, default=16, help="Kernel dimension in X")
 parser.add_argument("--kernel-dim-y", type=int, default=16, help="Kernel dimension in Y")
-parser.add_argument("--inp-rows", type=int, default=1024, help="Number of input rows")
-parser.add_argument("--inp-cols", type=int, default=1024, help="Number of input columns")
+parser.add_argument("--inp-rows", type=int, default=1024, help="Number of input rows, the largest run.py --inp-rows")
+parser.add_argument("--inp-cols", type=int, default=1024, help="Number of input columns, the largest run.py --inp-cols")
 parser.add_argument("--radius", type=int, default=1, help="stencil kernel radius")
-parser.add_argument("--iterations", type=int, default=100, help="Number of iterations")
-parser.add_argument("--channels", type=int, default=1, help="Number of channels for data streaming")
+parser.add_argument("--decimate", type=int, default=0, help="Decimation factor of the monitoring output (0 disables it)")
+parser.add_argument("--snapshot", type=int, default=0, help="Iterations between snapshots (0 disables them)")
+parser.add_argument("--slots", type=int, default=1, choices=[1, 2], help="Field slots (2: double-buffered jobs, see batch.py --pipeline)")
+parser.add_argument("--fields", type=int, default=1, help="Independent fields per PE (batch B), exchanged and computed together")
+parser.add_argument("--channels", type=int, default=0, help="Number of channels for data streaming (0: fastest measured by memcpy-bench)")
 
 args = parser.parse_args()
 
 # WSE3 cores
 fabric_dim_x = 762 
 fabric_dim_y = 1172
-channels = min(args.kernel_dim_y, args.channels)
-
-# Instantiate compiler using a context manager
-# Disable version check to ignore appliance client and server version differences.
-with SdkCompiler(disable_version_check=True) as compiler:
-
-    # Launch compile job
-    artifact_path = compiler.compile(
-        ".",
-        "layout.csl",
-        f'--fabric-dims={fabric_dim_x},{fabric_dim_y} --fabric-offsets=4,1 --params=kernel_dim_x:{args.kernel_dim_x},kernel_dim_y:{args.kernel_dim_y},M:{args.inp_rows},N:{args.inp_cols},radius:{args.radius},iterations:{args.iterations} -o out --memcpy --channels={channels} --arch=wse3',
-        "."
-    )
+
+# channel count measured to be the fastest for this transfer, unless given
+if args.channels > 0:
+    channels = min(args.kernel_dim_y, args.channels)
+else:
+    elements = (-(-args.inp_rows // args.kernel_dim_y) + 2*args.radius) * (-(-args.inp_cols // args.kernel_dim_x) + 2*args.radius)
+    channels = best_channels(args.kernel_dim_x, args.kernel_dim_y, elements)
+
+options = f'--fabric-dims={fabric_dim_x},{fabric_dim_y} --fabric-offsets=4,1 --params=kernel_dim_x:{args.kernel_dim_x},kernel_dim_y:{args.kernel_dim_y},M:{args.inp_rows},N:{args.inp_cols},radius:{args.radius},decimate:{args.decimate},snapshot:{args.snapshot},slots:{args.slots},fields:{args.fields} -o out --memcpy --channels={channels} --arch=wse3'
+
+# no compile if the sources and options are unchanged
+cache = CompileCache()
+key = cache.key(["."], options, sdk_version())
+artifact_path = cache.fetch_artifact(key)
+
+if artifact_path is None:
+    # Instantiate compiler using a context manager
+    # Disable version check to ignore appliance client and server version differences.
+    with SdkCompiler(disable_version_check=True) as compiler:
+
+        # Launch compile job
+        artifact_path = compiler.compile(
+            ".",
+            "layout.csl",
+            options,
+            "."
+        )
+
+    cache.store_artifact(key, artifact_path)
+else:
+    print(f"Compile cache hit {key[:12]}: {artifact_path}")
 
 # Write the artifact_path to a JSON file
 with open("artifact_path.json", "w", encoding="utf8") as f:
@@ -1,12 +1,23 @@
 import json
 import os
 import logging
+import argparse
 
 from cerebras.sdk.client import SdkLauncher
 from cerebras.appliance import logger
 
 logging.basicConfig(level=logging.INFO)
 
+parser = argparse.ArgumentParser(description="Run a compiled Cerebras stencil on the appliance.")
+parser.add_argument("--iterations", type=int, default=None, help="Number of iterations, set at run time (default: 1)")
+parser.add_argument("--inp-rows", type=int, default=None, help="Input rows, up to the compiled ones (default: the compiled value)")
+parser.add_argument("--inp-cols", type=int, default=None, help="Input columns, up to the compiled ones (default: the compiled value)")
+args = parser.parse_args()
+
+run_args = f" --iterations {args.iterations}" if args.iterations is not None else ""
+run_args += f" --inp-rows {args.inp_rows}" if args.inp_rows else ""
+run_args += f" --inp-cols {args.inp_cols}" if args.inp_cols else ""
+
 # read the compile artifact_path from the json file
 with open("artifact_path.json", "r", encoding="utf8") as f:
     data = json.load(f)
@@ -33,7 +44,7 @@ with SdkLauncher(artifact_path, simulator=False, disable_version_check=True) as
 
     # Run the original host code as-is on the appliance,
     # using the same cmd as when using the Singularity container
-    response = launcher.run("cs_python run.py --name out --arch wse3 --cmaddr %CMADDR%")
+    response = launcher.run("cs_python run.py --name out --arch wse3 --cmaddr %CMADDR%" + run_args)
     print("Host code execution response: ", response)
 
     # Fetch files from the appliance